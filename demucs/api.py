@@ -20,21 +20,67 @@ Examples
 See the end of this module (if __name__ == "__main__")
 """
 
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
+import logging
+import os
 import subprocess
+import warnings
+import weakref
 
 import torch as th
 import torchaudio as ta
+from torch import nn
 
 from dora.log import fatal
 from pathlib import Path
-from typing import Optional, Callable, Dict, Tuple, Union
+from typing import Optional, Callable, Dict, Tuple, Union, cast
 
-from .apply import apply_model, _replace_dict
-from .audio import AudioFile, convert_audio, save_audio
+from .apply import apply_model, overlap_weight, BagOfModels, Model, _valid_length
+from .audio import AudioFile, convert_audio, convert_audio_channels, encode_audio
+from .audio import save_audio  # noqa: F401, re-exported as `demucs.api.save_audio`
+from .audio import _load_audio_av, _load_audio_stream_reader
 from .pretrained import get_model, _parse_remote_files, REMOTE_ROOT
 from .repo import RemoteRepo, LocalRepo, ModelOnlyRepo, BagOnlyRepo
 
 
+logger = logging.getLogger(__name__)
+
+
+# Compiled modules, shared by all the separators using the same model with the same parameters
+# and released once none of them uses it anymore.
+_compiled_models: "weakref.WeakValueDictionary[tuple, th.jit.ScriptModule]" = \
+    weakref.WeakValueDictionary()
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_get_model(name: str, repo: Optional[Path]) -> nn.Module:
+    """
+    Load a model with `get_model`, keeping the last ones in memory so that creating other
+    separators with the same model does not read the checkpoint again. The returned model
+    is shared and should not be used directly, see `_copy_model`.
+    """
+    model = get_model(name=name, repo=repo)
+    if model is None:
+        raise LoadModelError("Failed to load model")
+    return model
+
+
+def _copy_model(model: nn.Module) -> nn.Module:
+    """
+    Copy `model` for a separator. The parameters and buffers of the copy share their memory
+    with `model`, but not the modules, so that moving the copy to another device or
+    quantizing it does not change `model`.
+    """
+    memo: dict = {}
+    for param in model.parameters():
+        memo[id(param)] = nn.Parameter(param.data, requires_grad=param.requires_grad)
+    for buffer in model.buffers():
+        memo[id(buffer)] = buffer
+    return copy.deepcopy(model, memo)
+
+
 class LoadAudioError(Exception):
     pass
 
@@ -50,6 +96,57 @@ class _NotProvided:
 NotProvided = _NotProvided()
 
 
+class _CompiledForward:
+    """
+    Replacement for the `forward` of a model, calling a TorchScript module for inputs
+    of the shape it has been compiled for, and the original `forward` otherwise
+    (e.g. for the last batch of segments, which may be smaller).
+    If `cuda_graph` is True, the first call with the compiled shape is captured into a
+    CUDA graph, which is replayed by the next calls to save the kernel launches.
+    """
+    def __init__(self, forward, compiled: th.jit.ScriptModule, shape: Tuple[int, ...],
+                 cuda_graph: bool = False):
+        self.forward = forward
+        self.compiled = compiled
+        self.shape = shape
+        self.cuda_graph = cuda_graph
+        self.graph: Optional[th.cuda.CUDAGraph] = None
+        self.static_in: Optional[th.Tensor] = None
+        self.static_out: Optional[th.Tensor] = None
+
+    def _capture(self, x: th.Tensor):
+        static_in = x.clone()
+        # Warm up on a side stream before capturing, as recommended by PyTorch.
+        stream = th.cuda.Stream()
+        stream.wait_stream(th.cuda.current_stream())
+        with th.cuda.stream(stream):
+            for _ in range(2):
+                self.compiled(static_in)
+        th.cuda.current_stream().wait_stream(stream)
+        graph = th.cuda.CUDAGraph()
+        with th.cuda.graph(graph):
+            static_out = self.compiled(static_in)
+        self.graph, self.static_in, self.static_out = graph, static_in, static_out
+
+    def __call__(self, x: th.Tensor) -> th.Tensor:
+        if tuple(x.shape) != self.shape:
+            return self.forward(x)
+        with th.jit.optimized_execution(False):
+            if self.cuda_graph and self.graph is None:
+                try:
+                    self._capture(x)
+                except Exception as err:
+                    logger.warning("Could not capture a CUDA graph, running without it: %s",
+                                   err)
+                    self.cuda_graph = False
+            if self.graph is None:
+                return self.compiled(x)
+            assert self.static_in is not None and self.static_out is not None
+            self.static_in.copy_(x)
+            self.graph.replay()
+            return self.static_out.clone()
+
+
 class Separator:
     def __init__(
         self,
@@ -64,6 +161,12 @@ class Separator:
         progress: bool = False,
         callback: Optional[Callable[[dict], None]] = None,
         callback_arg: Optional[dict] = None,
+        batch_size: int = 1,
+        use_autocast: bool = True,
+        autocast_dtype: Optional[th.dtype] = None,
+        jit: bool = False,
+        channels_last: bool = True,
+        quantize: bool = False,
     ):
         """
         `class Separator`
@@ -97,6 +200,23 @@ class Separator:
         callback_arg: A dict containing private parameters to be passed to callback function. For \
             more information, please see the Callback section.
         progress: If true, show a progress bar.
+        batch_size: Number of segments processed together by a single forward pass of the \
+            model (only available if `split` is `True`). Larger values will be faster on GPU but \
+            use more memory. If not specified, will use the command line option.
+        use_autocast: If True, run the model with mixed precision when `device` is a CUDA \
+            device. Disable it if you notice a drop of quality. No effect on other devices.
+        autocast_dtype: Data type used by mixed precision. If None, will use bfloat16 when the \
+            GPU supports it, else float16.
+        jit: If True, compile the model with TorchScript for the shape of a batch of segments \
+            (only available if `split` is `True`). The compilation is done before the first \
+            separation, and again every time `device`, `segment` or `batch_size` changes. On \
+            CUDA devices, the compiled model is also captured into a CUDA graph.
+        channels_last: If True, store the weights of 2d convolutions in channels last memory \
+            format when `device` is a CUDA device, which is faster with recent GPUs. No effect \
+            on other devices.
+        quantize: If True, quantize the linear and LSTM layers of the model to int8 when \
+            `device` is the CPU. This is faster, but the quality may be a bit worse. No effect on \
+            other devices.
 
         Callback
         --------
@@ -116,10 +236,15 @@ class Separator:
         """
         self._name = model
         self._repo = repo
+        # Reused by every separation to pass `callback_arg` and the audio length to
+        # `apply_model`, which copies it before calling `callback`.
+        self._callback_scratch: dict = {}
         self._load_model()
         self.update_parameter(device=device, shifts=shifts, overlap=overlap, split=split,
                               segment=segment, jobs=jobs, progress=progress, callback=callback,
-                              callback_arg=callback_arg)
+                              callback_arg=callback_arg, batch_size=batch_size,
+                              use_autocast=use_autocast, autocast_dtype=autocast_dtype, jit=jit,
+                              channels_last=channels_last, quantize=quantize)
 
     def update_parameter(
         self,
@@ -134,6 +259,12 @@ class Separator:
             Union[Callable[[dict], None], _NotProvided]
         ] = NotProvided,
         callback_arg: Optional[Union[dict, _NotProvided]] = NotProvided,
+        batch_size: Union[int, _NotProvided] = NotProvided,
+        use_autocast: Union[bool, _NotProvided] = NotProvided,
+        autocast_dtype: Optional[Union[th.dtype, _NotProvided]] = NotProvided,
+        jit: Union[bool, _NotProvided] = NotProvided,
+        channels_last: Union[bool, _NotProvided] = NotProvided,
+        quantize: Union[bool, _NotProvided] = NotProvided,
     ):
         """
         Update the parameters of separation.
@@ -164,6 +295,23 @@ class Separator:
         callback_arg: A dict containing private parameters to be passed to callback function. For \
             more information, please see the Callback section.
         progress: If true, show a progress bar.
+        batch_size: Number of segments processed together by a single forward pass of the \
+            model (only available if `split` is `True`). Larger values will be faster on GPU but \
+            use more memory. If not specified, will use the command line option.
+        use_autocast: If True, run the model with mixed precision when `device` is a CUDA \
+            device. Disable it if you notice a drop of quality. No effect on other devices.
+        autocast_dtype: Data type used by mixed precision. If None, will use bfloat16 when the \
+            GPU supports it, else float16.
+        jit: If True, compile the model with TorchScript for the shape of a batch of segments \
+            (only available if `split` is `True`). The compilation is done before the first \
+            separation, and again every time `device`, `segment` or `batch_size` changes. On \
+            CUDA devices, the compiled model is also captured into a CUDA graph.
+        channels_last: If True, store the weights of 2d convolutions in channels last memory \
+            format when `device` is a CUDA device, which is faster with recent GPUs. No effect \
+            on other devices.
+        quantize: If True, quantize the linear and LSTM layers of the model to int8 when \
+            `device` is the CPU. This is faster, but the quality may be a bit worse. No effect on \
+            other devices.
 
         Callback
         --------
@@ -199,25 +347,139 @@ class Separator:
             self._callback = callback
         if not isinstance(callback_arg, _NotProvided):
             self._callback_arg = callback_arg
+        if not isinstance(batch_size, _NotProvided):
+            self._batch_size = batch_size
+        if not isinstance(use_autocast, _NotProvided):
+            self._use_autocast = use_autocast
+        if not isinstance(autocast_dtype, _NotProvided):
+            self._autocast_dtype = autocast_dtype
+        if not isinstance(jit, _NotProvided):
+            self._jit = jit
+        if not isinstance(channels_last, _NotProvided):
+            self._channels_last = channels_last
+        if not isinstance(quantize, _NotProvided):
+            self._quantize = quantize
 
     def _load_model(self):
-        self._model = get_model(name=self._name, repo=self._repo)
-        if self._model is None:
-            raise LoadModelError("Failed to load model")
+        # Each separator has its own copy, as the model is moved between devices in place.
+        self._model = _copy_model(_cached_get_model(self._name, self._repo))
         self._audio_channels = self._model.audio_channels
         self._samplerate = self._model.samplerate
+        self._prepared_key: Optional[tuple] = None
+        self._quantized = False
+        self._weight_cache: Dict[tuple, th.Tensor] = {}
+
+    def _get_overlap_weight(self, length: int, transition_power: float, device) -> th.Tensor:
+        """
+        Same as `overlap_weight`, but computing the weight only the first time it is used
+        with the same arguments, as `apply_model` needs it for each model of a bag and
+        each separation.
+        """
+        key = (length, transition_power, str(device))
+        if key not in self._weight_cache:
+            self._weight_cache[key] = overlap_weight(length, transition_power, device)
+        return self._weight_cache[key]
+
+    def _prepare_model(self, use_autocast: bool, autocast_dtype: th.dtype):
+        """
+        Prepare the model for the current parameters. On CPU, quantize it if `quantize` is
+        enabled. On CUDA devices, convert its weights to channels last memory format if
+        `channels_last` is enabled. If `jit` is enabled, compile each (sub)model with TorchScript
+        for a batch of `batch_size` segments, and install the compiled module as its `forward`.
+        Does nothing if the model has already been prepared with the same parameters.
+        """
+        quantize = self._quantize and th.device(self._device).type == "cpu"
+        channels_last = self._channels_last and th.device(self._device).type == "cuda"
+        jit = self._jit and self._split
+        key = (quantize, channels_last, jit, str(self._device), self._segment, self._batch_size,
+               use_autocast, autocast_dtype)
+        if key == self._prepared_key:
+            return
+        if self._quantized and not quantize:
+            # Quantization cannot be reverted, get a fresh copy of the model instead.
+            self._load_model()
+        self._prepared_key = key
+        if isinstance(self._model, BagOfModels):
+            models = list(self._model.models)
+        else:
+            models = [self._model]
+        for model in models:
+            model.__dict__.pop("forward", None)
+        if quantize and not self._quantized:
+            # Only linear and LSTM layers support dynamic quantization, convolutions
+            # would need static quantization with calibration data.
+            for model in models:
+                th.ao.quantization.quantize_dynamic(
+                    model, {nn.Linear, nn.LSTM}, dtype=th.qint8, inplace=True)
+            self._quantized = True
+        # Only the weights of 2d convolutions are converted. Their outputs then follow
+        # the same memory format, which lets cuDNN use its faster NHWC kernels.
+        self._model.to(memory_format=th.channels_last if channels_last else th.contiguous_format)
+        if not jit:
+            return
+
+        # The weights are frozen into the compiled modules, so the model has to be moved to
+        # the device first.
+        self._model.to(self._device)
+        self._model.eval()
+        cuda_graph = th.device(self._device).type == "cuda"
+        for idx, model in enumerate(models):
+            cache_key = (self._name, self._repo, idx) + key
+            segment = self._segment or model.segment
+            length = _valid_length(cast(Model, model), int(self._samplerate * segment),
+                                   self._segment)
+            shape = (self._batch_size, self._audio_channels, length)
+            compiled = _compiled_models.get(cache_key)
+            if compiled is not None:
+                model.forward = _CompiledForward(model.forward, compiled, shape, cuda_graph)
+                continue
+            example = th.randn(*shape, device=self._device)
+            with warnings.catch_warnings(), th.no_grad():
+                warnings.simplefilter("ignore", th.jit.TracerWarning)
+                try:
+                    compiled = th.jit.script(model)
+                except Exception:
+                    try:
+                        compiled = th.jit.trace(model, example, check_trace=False)
+                    except Exception as err:
+                        logger.warning("Could not compile %s with TorchScript, using it "
+                                       "as is: %s", model.__class__.__name__, err)
+                        continue
+                compiled = th.jit.freeze(compiled.eval())
+                # The first calls of a TorchScript module are much slower than the next ones.
+                with th.jit.optimized_execution(False):
+                    for _ in range(2):
+                        compiled(example)
+            _compiled_models[cache_key] = compiled
+            model.forward = _CompiledForward(model.forward, compiled, shape, cuda_graph)
 
     def _load_audio(self, track: Path):
         errors = {}
         wav = None
 
         try:
-            wav = AudioFile(track).read(streams=0, samplerate=self._samplerate,
-                                        channels=self._audio_channels)
-        except FileNotFoundError:
-            errors["ffmpeg"] = "FFmpeg is not installed."
-        except subprocess.CalledProcessError:
-            errors["ffmpeg"] = "FFmpeg could not read the file."
+            wav = _load_audio_stream_reader(track, self._samplerate, self._audio_channels)
+        except ImportError:
+            errors["torchaudio.io"] = "torchaudio.io is not available."
+        except Exception as err:
+            errors["torchaudio.io"] = str(err)
+
+        if wav is None:
+            try:
+                wav = _load_audio_av(track, self._samplerate, self._audio_channels)
+            except ImportError:
+                errors["PyAV"] = "PyAV is not installed."
+            except Exception as err:
+                errors["PyAV"] = str(err)
+
+        if wav is None:
+            try:
+                wav = AudioFile(track).read(streams=0, samplerate=self._samplerate,
+                                            channels=self._audio_channels)
+            except FileNotFoundError:
+                errors["ffmpeg"] = "FFmpeg is not installed."
+            except subprocess.CalledProcessError:
+                errors["ffmpeg"] = "FFmpeg could not read the file."
 
         if wav is None:
             try:
@@ -225,7 +487,13 @@ class Separator:
             except RuntimeError as err:
                 errors["torchaudio"] = err.args[0]
             else:
-                wav = convert_audio(wav, sr, self._samplerate, self._audio_channels)
+                # Downmix before resampling and upmix after, so that only the channels
+                # which are needed get resampled.
+                if wav.shape[0] > self._audio_channels:
+                    wav = convert_audio_channels(wav, self._audio_channels)
+                if sr != self._samplerate:
+                    wav = ta.functional.resample(wav, sr, self._samplerate)
+                wav = convert_audio_channels(wav, self._audio_channels)
 
         if wav is None:
             raise LoadAudioError(
@@ -239,7 +507,7 @@ class Separator:
         return wav
 
     def separate_tensor(
-        self, wav: th.Tensor, sr: Optional[int] = None
+        self, wav: th.Tensor, sr: Optional[int] = None, normalize: bool = True
     ) -> Tuple[th.Tensor, Dict[str, th.Tensor]]:
         """
         Separate a loaded tensor.
@@ -251,6 +519,10 @@ class Separator:
             e.g. `tuple(wav.shape) == (2, 884000)` means the audio has 2 channels.
         sr: Sample rate of the original audio, the wave will be resampled if it doesn't match the \
             model.
+        normalize: If True, the wave is normalized before separation and the separated waves \
+            are scaled back. Only set it to False if the mono mix of `wav` (`wav.mean(0)`) has \
+            already been normalized to zero mean and unit standard deviation, as the model \
+            expects.
 
         Returns
         -------
@@ -262,33 +534,73 @@ class Separator:
         -----
         Use this function with cautiousness. This function does not provide data verifying.
         """
+        wav, out = self._separate(wav, sr, normalize)
+        return (wav, dict(zip(self._model.sources, out)))
+
+    def _separate(
+        self, wav: th.Tensor, sr: Optional[int] = None, normalize: bool = True
+    ) -> Tuple[th.Tensor, th.Tensor]:
+        """
+        Same as `separate_tensor`, but return the separated waves as a single tensor of shape
+        `[S, C, T]`, with S the number of sources in the order of `model.sources`.
+        """
         if sr is not None and sr != self.samplerate:
             wav = convert_audio(wav, sr, self._samplerate, self._audio_channels)
-        ref = wav.mean(0)
-        wav -= ref.mean()
-        wav /= ref.std() + 1e-8
-        out = apply_model(
-                self._model,
-                wav[None],
-                segment=self._segment,
-                shifts=self._shifts,
-                split=self._split,
-                overlap=self._overlap,
-                device=self._device,
-                num_workers=self._jobs,
-                callback=self._callback,
-                callback_arg=_replace_dict(
-                    self._callback_arg, ("audio_length", wav.shape[1])
-                ),
-                progress=self._progress,
-            )
+        if normalize:
+            # `wav.mean()` is the mean of the mono mix `wav.mean(0)`, no need to compute the mix.
+            ref_mean = wav.mean()
+            ref_std = wav.mean(0).std() + 1e-8
+            wav_norm = wav.sub(ref_mean).div_(ref_std)
+        else:
+            wav_norm = wav
+        use_autocast = self._use_autocast and th.device(self._device).type == "cuda"
+        autocast_dtype = self._autocast_dtype
+        if autocast_dtype is None:
+            if use_autocast and th.cuda.is_bf16_supported():
+                autocast_dtype = th.bfloat16
+            else:
+                autocast_dtype = th.float16
+        self._callback_scratch.clear()
+        self._callback_scratch.update(self._callback_arg or {})
+        self._callback_scratch["audio_length"] = wav.shape[1]
+        with th.autocast(device_type="cuda", dtype=autocast_dtype, enabled=use_autocast):
+            self._prepare_model(use_autocast, autocast_dtype)
+            out = apply_model(
+                    self._model,
+                    wav_norm[None],
+                    segment=self._segment,
+                    shifts=self._shifts,
+                    split=self._split,
+                    overlap=self._overlap,
+                    device=self._device,
+                    num_workers=self._jobs,
+                    callback=self._callback,
+                    callback_arg=self._callback_scratch,
+                    progress=self._progress,
+                    batch_size=self._batch_size,
+                    get_weight=self._get_overlap_weight,
+                )
         if out is None:
             raise KeyboardInterrupt
-        out *= ref.std() + 1e-8
-        out += ref.mean()
-        wav *= ref.std() + 1e-8
-        wav += ref.mean()
-        return (wav, dict(zip(self._model.sources, out[0])))
+        # Rescale in full precision, the model output may be in half precision. The statistics
+        # are 0-dim tensors, so the rescaling happens in place on the device of `out`.
+        out = out.float()
+        if normalize:
+            out.mul_(ref_std.to(out.device)).add_(ref_mean.to(out.device))
+        return (wav, out[0])
+
+    @staticmethod
+    def _transfer_to_host(out: th.Tensor) -> th.Tensor:
+        """
+        Copy all the separated sources to the CPU at once, rather than one copy per source.
+        """
+        if out.device.type != "cuda":
+            return out.cpu()
+        # The asynchronous copy has to be finished before the result is used on the CPU.
+        device = out.device
+        out = out.to("cpu", non_blocking=True)
+        th.cuda.synchronize(device)
+        return out
 
     def separate_audio_file(self, file: Path):
         """
@@ -362,31 +674,65 @@ if __name__ == "__main__":
         split=args.split,
         segment=args.segment,
         jobs=args.jobs,
+        batch_size=args.batch_size,
+        use_autocast=args.autocast,
+        jit=args.jit,
+        quantize=args.quantize,
         callback=print
     )
     out = args.out / args.name
     out.mkdir(parents=True, exist_ok=True)
-    for file in args.tracks:
-        separated = separator.separate_audio_file(file)[1]
-        if args.mp3:
-            ext = "mp3"
-        elif args.flac:
-            ext = "flac"
-        else:
-            ext = "wav"
-        kwargs = {
-            "samplerate": separator.samplerate,
-            "bitrate": args.mp3_bitrate,
-            "clip": args.clip_mode,
-            "as_float": args.float32,
-            "bits_per_sample": 24 if args.int24 else 16,
-        }
-        for stem, source in separated.items():
-            stem = out / args.filename.format(
-                track=Path(file).name.rsplit(".", 1)[0],
-                trackext=Path(file).name.rsplit(".", 1)[-1],
-                stem=stem,
-                ext=ext,
-            )
-            stem.parent.mkdir(parents=True, exist_ok=True)
-            save_audio(source, str(stem), **kwargs)
+    if args.mp3:
+        ext = "mp3"
+    elif args.flac:
+        ext = "flac"
+    else:
+        ext = "wav"
+    kwargs = {
+        "samplerate": separator.samplerate,
+        "bitrate": args.mp3_bitrate,
+        "clip": args.clip_mode,
+        "as_float": args.float32,
+        "bits_per_sample": 24 if args.int24 else 16,
+    }
+
+    def stem_path(file, stem):
+        path = out / args.filename.format(
+            track=Path(file).name.rsplit(".", 1)[0],
+            trackext=Path(file).name.rsplit(".", 1)[-1],
+            stem=stem,
+            ext=ext,
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return str(path)
+
+    def write(path, future):
+        Path(path).write_bytes(future.result())
+
+    # While a track is separated, the next one is loaded and the stems of the previous one
+    # are encoded and saved in parallel. Only one track is loaded and one is saved in advance,
+    # to bound the memory used. The stems are encoded by several threads, but written one
+    # after the other by a single thread so that the writes do not compete for the disk.
+    writers = min(4, os.cpu_count() or 1)
+    with ThreadPoolExecutor(1) as loader_pool, ThreadPoolExecutor(writers) as encoder_pool, \
+            ThreadPoolExecutor(1) as writer_pool:
+        loading = None
+        saving: list = []
+        for idx, file in enumerate(args.tracks):
+            if loading is None:
+                loading = loader_pool.submit(separator._load_audio, file)
+            wav = loading.result()
+            loading = None
+            if idx + 1 < len(args.tracks):
+                loading = loader_pool.submit(separator._load_audio, args.tracks[idx + 1])
+            separated = separator._transfer_to_host(
+                separator._separate(wav, separator.samplerate)[1])
+            for future in saving:
+                future.result()
+            saving = []
+            for stem, source in zip(separator.model.sources, separated):
+                path = stem_path(file, stem)
+                encoding = encoder_pool.submit(encode_audio, source, path, **kwargs)
+                saving.append(writer_pool.submit(write, path, encoding))
+        for future in saving:
+            future.result()
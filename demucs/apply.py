@@ -142,6 +142,43 @@ def _replace_dict(_dict: tp.Optional[dict], *subs: tp.Tuple[tp.Hashable, tp.Any]
     return _dict
 
 
+def _get_tensors(model: nn.Module) -> tp.List[tp.Tuple[tp.Any, str, th.Tensor]]:
+    """Return the parameters and buffers of `model`, to be put back by `_set_tensors`."""
+    tensors: tp.List[tp.Tuple[tp.Any, str, th.Tensor]] = []
+    for param in model.parameters():
+        tensors.append((param, "data", param.data))
+    for module in model.modules():
+        for name, buffer in module._buffers.items():
+            if buffer is not None:
+                tensors.append((module._buffers, name, buffer))
+    return tensors
+
+
+def _set_tensors(tensors: tp.List[tp.Tuple[tp.Any, str, th.Tensor]]):
+    """Put back the parameters and buffers returned by `_get_tensors`."""
+    for owner, name, tensor in tensors:
+        if isinstance(owner, dict):
+            owner[name] = tensor
+        else:
+            setattr(owner, name, tensor)
+
+
+def overlap_weight(segment_length: int, transition_power: float = 1.,
+                   device=None) -> th.Tensor:
+    """
+    Return the weight used by `apply_model` to interpolate between overlapping segments.
+    """
+    # We start from a triangle shaped weight, with maximal weight in the middle
+    # of the segment. Then we normalize and take to the power `transition_power`.
+    # Large values of transition power will lead to sharper transitions.
+    weight = th.cat([th.arange(1, segment_length // 2 + 1, device=device),
+                     th.arange(segment_length - segment_length // 2, 0, -1, device=device)])
+    assert len(weight) == segment_length
+    # If the overlap < 50%, this will translate to linear transition when
+    # transition_power is 1.
+    return (weight / weight.max())**transition_power
+
+
 def apply_model(model: tp.Union[BagOfModels, Model],
                 mix: tp.Union[th.Tensor, TensorChunk],
                 shifts: int = 1, split: bool = True,
@@ -150,7 +187,9 @@ def apply_model(model: tp.Union[BagOfModels, Model],
                 num_workers: int = 0, segment: tp.Optional[float] = None,
                 pool=None, lock=None,
                 callback: tp.Optional[tp.Callable[[dict], None]] = None,
-                callback_arg: tp.Optional[dict] = None) -> th.Tensor:
+                callback_arg: tp.Optional[dict] = None,
+                batch_size: int = 1,
+                get_weight: tp.Optional[tp.Callable[..., th.Tensor]] = None) -> th.Tensor:
     """
     Apply model to a given mixture.
 
@@ -170,7 +209,15 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         num_workers (int): if non zero, device is 'cpu', how many threads to
             use in parallel.
         segment (float or None): override the model segment parameter.
+        batch_size (int): when `split` is True, how many segments are stacked together and
+            processed by a single forward of the model. Larger values keep the GPU busier
+            at the cost of more memory.
+        get_weight (callable or None): if provided, called instead of `overlap_weight`
+            with the segment length, `transition_power` and `device`, e.g. to reuse the
+            weights computed by previous calls.
     """
+    if batch_size < 1:
+        raise ValueError(f"batch_size should be at least 1, got {batch_size}.")
     if device is None:
         device = mix.device
     else:
@@ -195,6 +242,8 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         'pool': pool,
         'segment': segment,
         'lock': lock,
+        'batch_size': batch_size,
+        'get_weight': get_weight,
     }
     out: tp.Union[float, th.Tensor]
     res: tp.Union[float, th.Tensor]
@@ -210,12 +259,15 @@ def apply_model(model: tp.Union[BagOfModels, Model],
                     lambda d, i=callback_arg["model_idx_in_bag"]: callback(
                         _replace_dict(d, ("model_idx_in_bag", i))) if callback else None)
             )
-            original_model_device = next(iter(sub_model.parameters())).device
+            # The submodel is not modified by the separation, so its original tensors are put
+            # back afterwards rather than copied back from `device`. This also keeps them
+            # shared with the other copies of the model.
+            tensors = _get_tensors(sub_model)
             sub_model.to(device)
 
             res = apply_model(sub_model, mix, **kwargs, callback_arg=callback_arg)
             out = res
-            sub_model.to(original_model_device)
+            _set_tensors(tensors)
             for k, inst_weight in enumerate(model_weights):
                 out[:, k, :, :] *= inst_weight
                 totals[k] += inst_weight
@@ -265,58 +317,91 @@ def apply_model(model: tp.Union[BagOfModels, Model],
         stride = int((1 - overlap) * segment_length)
         offsets = range(0, length, stride)
         scale = float(format(stride / model.samplerate, ".2f"))
-        # We start from a triangle shaped weight, with maximal weight in the middle
-        # of the segment. Then we normalize and take to the power `transition_power`.
-        # Large values of transition power will lead to sharper transitions.
-        weight = th.cat([th.arange(1, segment_length // 2 + 1, device=device),
-                         th.arange(segment_length - segment_length // 2, 0, -1, device=device)])
-        assert len(weight) == segment_length
-        # If the overlap < 50%, this will translate to linear transition when
-        # transition_power is 1.
-        weight = (weight / weight.max())**transition_power
+        weight = (get_weight or overlap_weight)(segment_length, transition_power, device)
+        # Only the chunks of a full segment are batched together. The last ones are shorter,
+        # and are processed one by one so that they are padded the same way whatever the
+        # `batch_size`, as the padding changes the output of Demucs and HDemucs models.
+        full_offsets = [offset for offset in offsets if offset + segment_length <= length]
+        batches = [full_offsets[start:start + batch_size]
+                   for start in range(0, len(full_offsets), batch_size)]
+        batches += [[offset] for offset in offsets[len(full_offsets):]]
         futures = []
-        for offset in offsets:
-            chunk = TensorChunk(mix, offset, segment_length)
-            future = pool.submit(apply_model, model, chunk, **kwargs, callback_arg=callback_arg,
-                                 callback=(lambda d, i=offset:
-                                           callback(_replace_dict(d, ("segment_offset", i)))
-                                           if callback else None))
-            futures.append((future, offset))
-            offset += segment_length
-        if progress:
-            futures = tqdm.tqdm(futures, unit_scale=scale, ncols=120, unit='seconds')
-        for future, offset in futures:
+        for batch_offsets in batches:
+            chunks = [TensorChunk(mix, offset, segment_length) for offset in batch_offsets]
+            callbacks = [(lambda d, i=offset: callback(_replace_dict(d, ("segment_offset", i)))
+                          if callback else None) for offset in batch_offsets]
+            future = pool.submit(_apply_segments, model, chunks, callbacks, segment=segment,
+                                 device=device, lock=lock, callback_arg=callback_arg)
+            futures.append((future, batch_offsets))
+        # The batches do not all have the same number of segments, so the progress bar is
+        # advanced by the size of each batch.
+        progress_bar = tqdm.tqdm(total=len(offsets), unit_scale=scale, ncols=120,
+                                 unit='seconds', disable=not progress)
+        for future, batch_offsets in futures:
             try:
-                chunk_out = future.result()  # type: th.Tensor
+                chunk_outs = future.result()  # type: tp.List[th.Tensor]
             except Exception:
+                progress_bar.close()
                 pool.shutdown(wait=True, cancel_futures=True)
                 raise
-            chunk_length = chunk_out.shape[-1]
-            out[..., offset:offset + segment_length] += (
-                weight[:chunk_length] * chunk_out).to(mix.device)
-            sum_weight[offset:offset + segment_length] += weight[:chunk_length].to(mix.device)
+            progress_bar.update(len(batch_offsets))
+            for offset, chunk_out in zip(batch_offsets, chunk_outs):
+                chunk_length = chunk_out.shape[-1]
+                out[..., offset:offset + segment_length] += (
+                    weight[:chunk_length] * chunk_out).to(mix.device)
+                sum_weight[offset:offset + segment_length] += (
+                    weight[:chunk_length].to(mix.device))
+        progress_bar.close()
         assert sum_weight.min() > 0
         out /= sum_weight
         assert isinstance(out, th.Tensor)
         return out
     else:
-        valid_length: int
-        if isinstance(model, HTDemucs) and segment is not None:
-            valid_length = int(segment * model.samplerate)
-        elif hasattr(model, 'valid_length'):
-            valid_length = model.valid_length(length)  # type: ignore
-        else:
-            valid_length = length
         mix = tensor_chunk(mix)
         assert isinstance(mix, TensorChunk)
-        padded_mix = mix.padded(valid_length).to(device)
-        with lock:
+        return _apply_segments(model, [mix], [callback], segment=segment, device=device,
+                               lock=lock, callback_arg=callback_arg)[0]
+
+
+def _valid_length(model: Model, length: int, segment: tp.Optional[float]) -> int:
+    """Return the length the input of `model` is padded to for a chunk of `length` samples."""
+    if isinstance(model, HTDemucs) and segment is not None:
+        return int(segment * model.samplerate)
+    elif hasattr(model, 'valid_length'):
+        return model.valid_length(length)  # type: ignore
+    else:
+        return length
+
+
+def _apply_segments(model: Model, chunks: tp.List[TensorChunk],
+                    callbacks: tp.List[tp.Optional[tp.Callable[[dict], None]]],
+                    segment: tp.Optional[float], device, lock,
+                    callback_arg: dict) -> tp.List[th.Tensor]:
+    """
+    Apply a single model to a list of chunks with one forward pass, stacking them
+    along the batch dimension. All the chunks are padded to the same valid length,
+    and each output is trimmed back to the length of its chunk.
+    `callbacks[k]` is called when the separation of `chunks[k]` starts and ends.
+    """
+    valid_length = _valid_length(model, max(chunk.length for chunk in chunks), segment)
+    padded = [chunk.padded(valid_length) for chunk in chunks]
+    if device.type == 'cuda' and padded[0].device.type == 'cpu':
+        # Gather the batch in page-locked memory, so that it is copied asynchronously.
+        batch = th.empty(sum(p.shape[0] for p in padded), *padded[0].shape[1:],
+                         dtype=padded[0].dtype, pin_memory=True)
+        padded_mix = th.cat(padded, out=batch).to(device, non_blocking=True)
+    else:
+        padded_mix = th.cat(padded).to(device)
+    with lock:
+        for callback in callbacks:
             if callback is not None:
-                callback(_replace_dict(callback_arg, ("state", "start")))  # type: ignore
-        with th.no_grad():
-            out = model(padded_mix)
-        with lock:
+                callback(_replace_dict(callback_arg, ("state", "start")))
+    with th.no_grad():
+        out = model(padded_mix)
+    with lock:
+        for callback in callbacks:
             if callback is not None:
-                callback(_replace_dict(callback_arg, ("state", "end")))  # type: ignore
-        assert isinstance(out, th.Tensor)
-        return center_trim(out, length)
+                callback(_replace_dict(callback_arg, ("state", "end")))
+    assert isinstance(out, th.Tensor)
+    return [center_trim(chunk_out, chunk.length)
+            for chunk_out, chunk in zip(out.chunk(len(chunks)), chunks)]
@@ -3,6 +3,7 @@
 #
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
+import io
 import json
 import subprocess as sp
 from pathlib import Path
@@ -140,6 +141,82 @@ class AudioFile:
         return wav
 
 
+def _concat_chunks(chunks: tp.Iterable[torch.Tensor], length: int) -> torch.Tensor:
+    """
+    Copy the `chunks` of shape [C, T] one after the other into a single buffer,
+    allocated for `length` samples and grown if `length` was underestimated.
+    """
+    buf = torch.empty(0, 0)
+    offset = 0
+    for chunk in chunks:
+        size = chunk.shape[1]
+        if not buf.numel():
+            buf = torch.empty(chunk.shape[0], max(length, size))
+        elif offset + size > buf.shape[1]:
+            grown = torch.empty(buf.shape[0], max(offset + size, 2 * buf.shape[1]))
+            grown[:, :offset].copy_(buf[:, :offset])
+            buf = grown
+        buf[:, offset:offset + size].copy_(chunk)
+        offset += size
+    return buf[:, :offset]
+
+
+def _load_audio_stream_reader(path: tp.Union[str, Path], samplerate: int,
+                              channels: int) -> torch.Tensor:
+    """
+    Decode the default audio stream of `path` in process with `torchaudio.io.StreamReader`,
+    which resamples it to `samplerate` while decoding, 10 seconds at a time.
+    Channels are converted afterwards with :func:`convert_audio_channels`,
+    for the same reason as in :method:`AudioFile.read`.
+    """
+    from torchaudio.io import StreamReader
+
+    reader = StreamReader(str(path))
+    index = reader.default_audio_stream
+    if index is None:
+        raise ValueError("No audio stream found.")
+    info = reader.get_src_stream_info(index)
+    # `num_frames` is 0 when the duration is not in the metadata.
+    length = int(info.num_frames * samplerate / info.sample_rate) + 1
+    # The output is float32 by default, `format` (`dtype` before torchaudio 2.0) is not set
+    # to support every version providing `StreamReader`.
+    reader.add_basic_audio_stream(frames_per_chunk=10 * samplerate, stream_index=index,
+                                  sample_rate=samplerate)
+    wav = _concat_chunks((chunk.t() for chunk, in reader.stream()), length)
+    return convert_audio_channels(wav, channels)
+
+
+def _load_audio_av(path: tp.Union[str, Path], samplerate: int, channels: int) -> torch.Tensor:
+    """
+    Decode the first audio stream of `path` in process with PyAV, resampling it on the fly
+    to `samplerate`. Channels are converted afterwards with :func:`convert_audio_channels`,
+    for the same reason as in :method:`AudioFile.read`.
+    """
+    import av
+
+    with av.open(str(path)) as container:
+        stream = container.streams.audio[0]
+        # The buffer is sized from the duration in the metadata when available,
+        # and grown if the estimation is too short.
+        if stream.duration is not None and stream.time_base is not None:
+            length = int(stream.duration * stream.time_base * samplerate) + 1
+        elif container.duration is not None:
+            length = int(container.duration * samplerate / av.time_base) + 1
+        else:
+            length = samplerate
+        resampler = av.AudioResampler(format="fltp", rate=samplerate)
+
+        def _resampled():
+            for frame in container.decode(stream):
+                for resampled in resampler.resample(frame):
+                    yield torch.from_numpy(resampled.to_ndarray())
+            for resampled in resampler.resample(None):
+                yield torch.from_numpy(resampled.to_ndarray())
+
+        wav = _concat_chunks(_resampled(), length)
+    return convert_audio_channels(wav, channels)
+
+
 def convert_audio_channels(wav, channels=2):
     """Convert audio to the given number of channels."""
     *shape, src_channels, length = wav.shape
@@ -196,8 +273,8 @@ def as_dtype_pcm(wav, dtype):
         return i16_pcm(wav)
 
 
-def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=False):
-    """Save given audio as mp3. This should work on all OSes."""
+def _mp3_bytes(wav, samplerate=44100, bitrate=320, quality=2, verbose=False):
+    """Encode given audio as mp3 and return the content of the file."""
     C, T = wav.shape
     wav = i16_pcm(wav)
     encoder = lameenc.Encoder()
@@ -211,6 +288,12 @@ def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=Fals
     wav = wav.transpose(0, 1).numpy()
     mp3_data = encoder.encode(wav.tobytes())
     mp3_data += encoder.flush()
+    return bytes(mp3_data)
+
+
+def encode_mp3(wav, path, samplerate=44100, bitrate=320, quality=2, verbose=False):
+    """Save given audio as mp3. This should work on all OSes."""
+    mp3_data = _mp3_bytes(wav, samplerate, bitrate, quality, verbose)
     with open(path, "wb") as f:
         f.write(mp3_data)
 
@@ -223,7 +306,10 @@ def prevent_clip(wav, mode='rescale'):
         return wav
     assert wav.dtype.is_floating_point, "too late for clipping"
     if mode == 'rescale':
-        wav = wav / max(1.01 * wav.abs().max(), 1)
+        # The infinity norm is the peak amplitude, computed without allocating `wav.abs()`.
+        # Staying on tensors also avoids a synchronization when `wav` is on GPU.
+        peak = torch.linalg.vector_norm(wav, ord=float('inf'))
+        wav = wav / (1.01 * peak).clamp_min_(1)
     elif mode == 'clamp':
         wav = wav.clamp(-0.99, 0.99)
     elif mode == 'tanh':
@@ -233,6 +319,55 @@ def prevent_clip(wav, mode='rescale'):
     return wav
 
 
+def _write_audio(wav: torch.Tensor, dest: tp.Union[str, tp.BinaryIO], suffix: str,
+                 samplerate: int, bitrate: int, bits_per_sample: int, as_float: bool,
+                 preset: int):
+    """Encode `wav` in the format given by `suffix` to `dest`, a path or a file-like object.
+    See :func:`save_audio` for the other arguments.
+    """
+    # torchaudio can only guess the format from the path.
+    audio_format = None if isinstance(dest, str) else suffix[1:]
+    if suffix == ".mp3":
+        if isinstance(dest, str):
+            encode_mp3(wav, dest, samplerate, bitrate, preset, verbose=True)
+        else:
+            dest.write(_mp3_bytes(wav, samplerate, bitrate, preset, verbose=True))
+    elif suffix == ".wav":
+        if as_float:
+            bits_per_sample = 32
+            encoding = 'PCM_F'
+        else:
+            encoding = 'PCM_S'
+        ta.save(dest, wav, sample_rate=samplerate, format=audio_format,
+                encoding=encoding, bits_per_sample=bits_per_sample)
+    elif suffix == ".flac":
+        ta.save(dest, wav, sample_rate=samplerate, format=audio_format,
+                bits_per_sample=bits_per_sample)
+    else:
+        raise ValueError(f"Invalid suffix for path: {suffix}")
+
+
+def encode_audio(wav: torch.Tensor,
+                 path: tp.Union[str, Path],
+                 samplerate: int,
+                 bitrate: int = 320,
+                 clip: tp.Literal["rescale", "clamp", "tanh", "none"] = 'rescale',
+                 bits_per_sample: tp.Literal[16, 24, 32] = 16,
+                 as_float: bool = False,
+                 preset: tp.Literal[2, 3, 4, 5, 6, 7] = 2) -> memoryview:
+    """Encode audio in memory, with the same arguments as :func:`save_audio`, and return
+    the content of the file. `path` is only used to choose the format from its suffix.
+    This lets the CPU bound encoding and the disk write be done by different threads,
+    but needs torchaudio to support file-like objects, prefer :func:`save_audio` otherwise.
+    """
+    wav = prevent_clip(wav, mode=clip)
+    buf = io.BytesIO()
+    _write_audio(wav, buf, Path(path).suffix.lower(), samplerate, bitrate, bits_per_sample,
+                 as_float, preset)
+    # A view of the buffer rather than a copy, to hold the encoded file only once.
+    return buf.getbuffer()
+
+
 def save_audio(wav: torch.Tensor,
                path: tp.Union[str, Path],
                samplerate: int,
@@ -248,18 +383,5 @@ def save_audio(wav: torch.Tensor,
     """
     wav = prevent_clip(wav, mode=clip)
     path = Path(path)
-    suffix = path.suffix.lower()
-    if suffix == ".mp3":
-        encode_mp3(wav, path, samplerate, bitrate, preset, verbose=True)
-    elif suffix == ".wav":
-        if as_float:
-            bits_per_sample = 32
-            encoding = 'PCM_F'
-        else:
-            encoding = 'PCM_S'
-        ta.save(str(path), wav, sample_rate=samplerate,
-                encoding=encoding, bits_per_sample=bits_per_sample)
-    elif suffix == ".flac":
-        ta.save(str(path), wav, sample_rate=samplerate, bits_per_sample=bits_per_sample)
-    else:
-        raise ValueError(f"Invalid suffix for path: {suffix}")
+    _write_audio(wav, str(path), path.suffix.lower(), samplerate, bitrate, bits_per_sample,
+                 as_float, preset)
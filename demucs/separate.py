@@ -95,6 +95,25 @@ def get_parser():
                         type=int,
                         help="Number of jobs. This can increase memory usage but will "
                              "be much faster when multiple cores are available.")
+    parser.add_argument("-b", "--batch-size",
+                        default=1,
+                        type=int,
+                        help="Number of segments processed together by the model. This can "
+                             "increase memory usage but will be faster on GPU.")
+    parser.add_argument("--no-autocast",
+                        action="store_false",
+                        dest="autocast",
+                        default=True,
+                        help="Don't use mixed precision on CUDA devices. This is slower but "
+                             "can help if you notice a drop of quality.")
+    parser.add_argument("--jit",
+                        action="store_true",
+                        help="Compile the model with TorchScript before separating. This takes "
+                             "some time at startup but can speed up long tracks.")
+    parser.add_argument("--quantize",
+                        action="store_true",
+                        help="Quantize the model to int8 when running on CPU. This is faster "
+                             "but the quality may be a bit worse.")
 
     return parser
 
@@ -113,6 +132,8 @@ def main(opts=None):
         print("error: the following arguments are required: tracks", file=sys.stderr)
         sys.exit(1)
 
+    if args.batch_size < 1:
+        fatal("--batch-size should be at least 1.")
     try:
         separator = Separator(model=args.name,
                               repo=args.repo,
@@ -122,7 +143,11 @@ def main(opts=None):
                               overlap=args.overlap,
                               progress=True,
                               jobs=args.jobs,
-                              segment=args.segment)
+                              segment=args.segment,
+                              batch_size=args.batch_size,
+                              use_autocast=args.autocast,
+                              jit=args.jit,
+                              quantize=args.quantize)
     except ModelLoadingError as error:
         fatal(error.args[0])
 
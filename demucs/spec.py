@@ -5,9 +5,18 @@
 # LICENSE file in the root directory of this source tree.
 """Conveniance wrapper to perform STFT and iSTFT"""
 
+import functools
+
 import torch as th
 
 
+@functools.lru_cache(maxsize=16)
+def _hann_window(win_length, device, dtype):
+    # The window only depends on its length, device and dtype, so it is built once
+    # instead of at every forward and copied to the device each time.
+    return th.hann_window(win_length, device=device, dtype=dtype)
+
+
 def spectro(x, n_fft=512, hop_length=None, pad=0):
     *other, length = x.shape
     x = x.reshape(-1, length)
@@ -17,7 +26,7 @@ def spectro(x, n_fft=512, hop_length=None, pad=0):
     z = th.stft(x,
                 n_fft * (1 + pad),
                 hop_length or n_fft // 4,
-                window=th.hann_window(n_fft).to(x),
+                window=_hann_window(n_fft, x.device, x.dtype),
                 win_length=n_fft,
                 normalized=True,
                 center=True,
@@ -38,7 +47,7 @@ def ispectro(z, hop_length=None, length=None, pad=0):
     x = th.istft(z,
                  n_fft,
                  hop_length,
-                 window=th.hann_window(win_length).to(z.real),
+                 window=_hann_window(win_length, z.device, z.real.dtype),
                  win_length=win_length,
                  normalized=True,
                  length=length,